@@ -1,7 +1,21 @@
 import streamlit as st
 import pandas as pd
-import plotly.express as px
+import numpy as np
+import plotly.graph_objects as go
 import zipfile
+import hashlib
+import io
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+# Parse CSVs with the multithreaded pyarrow engine and keep Parquet snapshots when it is installed
+try:
+    import pyarrow  # noqa: F401
+    has_pyarrow = True
+except ImportError:
+    has_pyarrow = False
+csv_engine = 'pyarrow' if has_pyarrow else 'c'
 
 # Set page configuration
 st.set_page_config(layout="wide")
@@ -32,88 +46,277 @@ room_assignments = {
     "Dragonfly": "Room 2"
 }
 
+# Room categories shared by every load, so the 'room' column always has the same codes
+room_dtype = pd.CategoricalDtype(sorted(set(room_assignments.values())) + ["Unknown"])
+
+# Define 'Mariana' parameters
+mariana_parameters = [
+    'Atmosphere temperature (°C)', 'Atmosphere humidity (% RH)', 
+    'FRT tension 1 (kPa)', 'FRT tension 2 (kPa)', 'FRT tension 3 (kPa)', 
+    'SMT temperature 1 (°C)', 'SMT temperature 2 (°C)', 'SMT temperature 3 (°C)', 
+    'SMT water content 1 (%)', 'SMT water content 2 (%)', 'SMT water content 3 (%)'
+]
+
+# Column name prefixes of the sensor readings loaded unless all columns are requested
+default_column_prefixes = ('SMT ', 'FRT ', 'Atmosphere')
+
+# Filename prefixes that map to multi-word device names
+device_name_fixes = {"Fire": "Fire bug", "Stag": "Stag beetle"}
+
+# Format of the 'timestamp' column in the device CSV exports
+timestamp_format = '%d.%m.%Y %H:%M:%S'
+
+# Maximum number of points sent to the browser for each plotted trace
+max_points_per_trace = 2000
+
+# Number of filtered rows from which charts switch from SVG to WebGL traces
+min_webgl_rows = 1000
+
+# Number of prepared frames kept in memory and how long each one is kept before it is prepared again
+prepared_cache_entries = 4
+prepared_cache_ttl = '1h'
+
+# Directory of Parquet snapshots of parsed device CSVs, shared by all sessions and kept across restarts
+snapshot_dir = os.path.join(tempfile.gettempdir(), 'ugt_csv_snapshots')
+
+# Part of every snapshot name; bump it whenever read_device_csv's output changes so old snapshots are ignored
+snapshot_version = 1
+
+# Total size the snapshot directory is trimmed to, least recently used snapshots first
+max_snapshot_bytes = 512 * 1024 * 1024
+
+# Function to downsample a trace to the minimum and maximum of evenly sized buckets so peaks stay visible
+# Non-numeric columns have no minimum or maximum to keep, so they are passed through unchanged
+def downsample_minmax(x, y, n_out=max_points_per_trace):
+    if len(y) <= n_out or not np.issubdtype(y.dtype, np.number):
+        return x, y
+    bucket_size = -(-len(y) // (n_out // 2))
+    n_buckets = -(-len(y) // bucket_size)
+    buckets = np.full(n_buckets * bucket_size, np.nan)
+    buckets[:len(y)] = y
+    buckets = buckets.reshape(n_buckets, bucket_size)
+    missing = np.isnan(buckets)
+    offsets = np.arange(n_buckets) * bucket_size
+    min_idx = np.where(missing, np.inf, buckets).argmin(axis=1) + offsets
+    max_idx = np.where(missing, -np.inf, buckets).argmax(axis=1) + offsets
+    idx = np.unique(np.concatenate([min_idx, max_idx]))
+    idx = idx[idx < len(y)]
+    return x[idx], y[idx]
+
+# Function to shrink the combined DataFrame: float32 sensor readings and categorical labels
+def optimize_dtypes(df):
+    float_cols = df.select_dtypes(include='float').columns
+    df[float_cols] = df[float_cols].astype('float32')
+    df['device'] = df['device'].astype('category')
+    df['room'] = df['room'].astype(room_dtype)
+    return df
+
+# Function to fingerprint uploaded bytes so cached steps are keyed on a short digest
+def content_key(contents):
+    return hashlib.blake2b(contents, digest_size=16).hexdigest()
+
+# Function to locate the snapshot of one CSV, named after its contents, the column choice and the snapshot version
+def snapshot_path(contents, load_all_columns):
+    columns = 'all' if load_all_columns else 'default'
+    return os.path.join(snapshot_dir, f'v{snapshot_version}-{columns}-{content_key(contents)}.parquet')
+
+# Function to write a parsed CSV to its snapshot and trim the directory back to its size limit
+# Snapshots are only a shortcut, so any failure here leaves the upload parsed as usual
+def save_snapshot(df, path):
+    tmp_path = None
+    try:
+        os.makedirs(snapshot_dir, exist_ok=True)
+        # Write to a temporary file first so other sessions never read a partial snapshot
+        with tempfile.NamedTemporaryFile(dir=snapshot_dir, suffix='.tmp', delete=False) as tmp:
+            tmp_path = tmp.name
+        df.to_parquet(tmp_path, index=False, compression='zstd')
+        os.replace(tmp_path, path)
+
+        snapshots = sorted((entry for entry in os.scandir(snapshot_dir) if entry.name.endswith('.parquet')), key=lambda entry: entry.stat().st_mtime, reverse=True)
+        total_bytes = 0
+        for entry in snapshots:
+            total_bytes += entry.stat().st_size
+            if total_bytes > max_snapshot_bytes:
+                os.remove(entry.path)
+    except Exception:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# Function to parse one device CSV, keeping only timestamps and the default sensor columns unless all columns are requested
+# With pyarrow installed the result is restored from its Parquet snapshot when one exists, so a CSV is parsed
+# only once even across sessions, restarts and cache evictions
+def read_device_csv(contents, load_all_columns):
+    path = snapshot_path(contents, load_all_columns) if has_pyarrow else None
+    if path and os.path.exists(path):
+        try:
+            df = pd.read_parquet(path)
+            # Mark the snapshot as recently used so trimming removes older ones first
+            os.utime(path)
+            return df
+        except Exception:
+            pass  # Unreadable snapshot; parse the CSV again and replace it
+
+    usecols = None
+    if not load_all_columns:
+        header = pd.read_csv(io.BytesIO(contents), delimiter=';', nrows=0).columns
+        usecols = [col for col in header if col == 'timestamp' or col in mariana_parameters or col.startswith(default_column_prefixes)]
+    df = pd.read_csv(io.BytesIO(contents), delimiter=';', engine=csv_engine, usecols=usecols, parse_dates=['timestamp'], date_format=timestamp_format, cache_dates=True)
+    # The device and room columns are derived from the filename, so drop any the export already has
+    df = df.drop(columns=['device', 'room'], errors='ignore')
+    if path:
+        save_snapshot(df, path)
+    return df
+
 # Function to load multiple CSV files into a single DataFrame
-def load_data(uploaded_files):
+# Files are (name, contents) pairs
+def load_data(uploaded_files, load_all_columns=False):
     data_frames = []
-    for uploaded_file in uploaded_files:
+    errors = []
+    for file_name, contents in uploaded_files:
         try:
-            df = pd.read_csv(uploaded_file, delimiter=';')
+            df = read_device_csv(contents, load_all_columns)
             # Infer device name from the filename
-            device_name = uploaded_file.name.split('_')[0]
-            if device_name == "Fire":
-                device_name = "Fire bug"
-            elif device_name == "Stag":
-                device_name = "Stag beetle"
-            df['device'] = device_name
-            df['room'] = room_assignments.get(device_name, "Unknown")
+            device_name = file_name.split('_', 1)[0]
+            df.insert(0, 'device', device_name_fixes.get(device_name, device_name))
             data_frames.append(df)
         except Exception as e:
-            st.error(f"Error reading {uploaded_file.name}: {e}")
+            errors.append(f"Error reading {file_name}: {e}")
+    
+    # Report all unreadable files in a single message
+    if errors:
+        st.error("\n".join(f"- {error}" for error in errors))
     
     if not data_frames:
         st.error("No data frames were created from the uploaded files.")
         return pd.DataFrame()
     
     combined_df = pd.concat(data_frames, ignore_index=True)
-    return combined_df
+    combined_df.insert(1, 'room', combined_df['device'].map(room_assignments).fillna("Unknown"))
+    return optimize_dtypes(combined_df)
+
+# Function to read one CSV member of a ZIP archive; each call opens its own handle so members can be read from worker threads
+def read_zip_member(zip_contents, filename, load_all_columns):
+    with zipfile.ZipFile(io.BytesIO(zip_contents)) as z:
+        df = read_device_csv(z.read(filename), load_all_columns)
+    # Infer device name from the filename
+    device_name = filename.split('/')[0].split('_', 1)[0]
+    df.insert(0, 'device', device_name_fixes.get(device_name, device_name))
+    return df
 
 # Function to load multiple CSV files from a ZIP into a single DataFrame
-def load_data_from_zip(zip_file):
+def load_data_from_zip(zip_contents, load_all_columns=False):
     data_frames = []
-    with zipfile.ZipFile(zip_file) as z:
-        for filename in z.namelist():
-            if filename.endswith('.csv') and not filename.startswith('__MACOSX/'):
-                with z.open(filename) as f:
-                    try:
-                        df = pd.read_csv(f, delimiter=';')
-                        # Infer device name from the filename
-                        device_name = filename.split('/')[0].split('_')[0]
-                        if device_name == "Fire":
-                            device_name = "Fire bug"
-                        elif device_name == "Stag":
-                            device_name = "Stag beetle"
-                        df['device'] = device_name
-                        df['room'] = room_assignments.get(device_name, "Unknown")
-                        data_frames.append(df)
-                    except Exception as e:
-                        st.error(f"Error reading {filename}: {e}")
+    errors = []
+    with zipfile.ZipFile(io.BytesIO(zip_contents)) as z:
+        filenames = [filename for filename in z.namelist() if filename.endswith('.csv') and not filename.startswith('__MACOSX/')]
+    
+    # Decompress and parse the members in parallel; zlib and the CSV parsers release the GIL
+    with ThreadPoolExecutor(max_workers=max(1, min(8, len(filenames)))) as executor:
+        futures = [executor.submit(read_zip_member, zip_contents, filename, load_all_columns) for filename in filenames]
+        for filename, future in zip(filenames, futures):
+            try:
+                data_frames.append(future.result())
+            except Exception as e:
+                errors.append(f"Error reading {filename}: {e}")
+    
+    # Report all unreadable files in a single message
+    if errors:
+        st.error("\n".join(f"- {error}" for error in errors))
     
     if not data_frames:
         st.error("No data frames were created from the ZIP file.")
         return pd.DataFrame()
     
     combined_df = pd.concat(data_frames, ignore_index=True)
-    return combined_df
+    combined_df.insert(1, 'room', combined_df['device'].map(room_assignments).fillna("Unknown"))
+    return optimize_dtypes(combined_df)
+
+# Function to load the uploads, convert timestamps, fill missing values and order the combined data
+# Keyed on the uploads' digests and the column choice, so the files are only parsed on a cache miss
+# Bounded so a server shared by many sessions holds only a few prepared frames in memory
+@st.cache_data(show_spinner=False, max_entries=prepared_cache_entries, ttl=prepared_cache_ttl)
+def prepare_data(_uploaded_files, _zip_contents, data_key, load_all_columns=False):
+    if _uploaded_files:
+        data = load_data(_uploaded_files, load_all_columns)
+    else:
+        data = load_data_from_zip(_zip_contents, load_all_columns)
+    if data.empty:
+        return data
+
+    # Timestamps are parsed per file while reading; convert any values that could not be parsed there
+    if not pd.api.types.is_datetime64_any_dtype(data['timestamp']):
+        data['timestamp'] = pd.to_datetime(data['timestamp'], format=timestamp_format)
+
+    # Sort by timestamp once so each device's rows are in time order for gap filling
+    # and the date range can be located with a binary search
+    data = data.sort_values('timestamp', kind='mergesort', ignore_index=True)
+
+    # Handle missing values per device so gaps are never filled from another device's readings
+    numeric_cols = data.select_dtypes(include='number').columns
+    data[numeric_cols] = data.groupby('device', observed=True, group_keys=False)[numeric_cols].apply(lambda g: g.interpolate(limit_direction='both'))
+    return data
+
+# Function to select parameters and draw their charts and the raw data table
+# Runs as a fragment so changing the parameter selection only reruns this part of the page
+@st.fragment
+def show_visualizations(filtered_data, selected_devices, all_columns):
+    parameter_options = ['Mariana'] + all_columns
+    selected_parameters = st.multiselect('Select Parameters', parameter_options, default=parameter_options[:1])
+
+    # Automatically select 'Mariana' parameters if 'Mariana' is chosen
+    if 'Mariana' in selected_parameters:
+        selected_parameters = [param for param in selected_parameters if param != 'Mariana'] + [param for param in mariana_parameters if param in all_columns]
+
+    if selected_parameters and not filtered_data.empty:
+        # Split the filtered data by device once instead of scanning it per device and parameter
+        device_groups = dict(tuple(filtered_data.groupby('device', observed=True)))
+        # WebGL keeps long time series responsive; small selections stay on SVG and use no WebGL contexts
+        trace_type = go.Scattergl if len(filtered_data) >= min_webgl_rows else go.Scatter
+        for parameter in selected_parameters:
+            fig = go.Figure()
+            for device in selected_devices:
+                if device not in device_groups:
+                    continue
+                device_data = device_groups[device]
+                x, y = downsample_minmax(device_data['timestamp'].to_numpy(), device_data[parameter].to_numpy())
+                fig.add_trace(trace_type(x=x, y=y, mode='lines', name=f'{device} - {parameter}', connectgaps=False))
+            fig.update_layout(title=f'Time Series Comparison for {parameter}', xaxis_title='Timestamp', yaxis_title=parameter, width=1200, height=600, uirevision='keep')
+            st.plotly_chart(fig, width='content', config={'responsive': False})
+    
+        # Display the filtered data as a table below the plots
+        st.subheader('Raw Data')
+        st.dataframe(filtered_data, width='stretch', height=400)
+    else:
+        st.write("No data available for the selected parameters and date range.")
 
 # Upload CSV or ZIP files
 st.title('Upload CSV or ZIP files')
 uploaded_files = st.file_uploader("Upload CSV files", accept_multiple_files=True, type="csv")
 uploaded_zip = st.file_uploader("Upload a ZIP file containing CSV files", type="zip")
+load_all_columns = st.checkbox('Load all columns', value=False, help="By default only the atmosphere, FRT and SMT sensor columns are loaded.")
 
-data = pd.DataFrame()
+sources = None
+zip_contents = None
 
-# Load data from uploaded files
+# Fingerprint the uploaded files
 if uploaded_files:
-    data = load_data(uploaded_files)
+    sources = tuple((uploaded_file.name, uploaded_file.getvalue()) for uploaded_file in uploaded_files)
+    data_key = tuple((file_name, content_key(contents)) for file_name, contents in sources)
 elif uploaded_zip:
-    data = load_data_from_zip(uploaded_zip)
-
-if data.empty:
+    zip_contents = uploaded_zip.getvalue()
+    data_key = content_key(zip_contents)
+else:
     st.stop()
 
-# Convert timestamp to datetime
+# Load, convert timestamps, fill gaps and sort; cached so widget interactions skip this work
 try:
-    data['timestamp'] = pd.to_datetime(data['timestamp'], format='%d.%m.%Y %H:%M:%S')
+    data = prepare_data(sources, zip_contents, data_key, load_all_columns)
 except Exception as e:
-    st.error(f"Error converting timestamp: {e}")
+    st.error(f"Error loading data: {e}")
     st.stop()
 
-# Handle missing values
-data = data.interpolate().ffill().bfill()
-
-# Reorder columns to have 'device' as the first column
-columns = ['device', 'room'] + [col for col in data.columns if col not in ['device', 'room']]
-data = data[columns]
+if data.empty:
+    st.stop()
 
 # Get all column names for selection
 all_columns = data.columns.tolist()
@@ -121,14 +324,6 @@ if 'timestamp' in all_columns: all_columns.remove('timestamp')
 if 'device' in all_columns: all_columns.remove('device')
 if 'room' in all_columns: all_columns.remove('room')
 
-# Define 'Mariana' parameters
-mariana_parameters = [
-    'Atmosphere temperature (°C)', 'Atmosphere humidity (% RH)', 
-    'FRT tension 1 (kPa)', 'FRT tension 2 (kPa)', 'FRT tension 3 (kPa)', 
-    'SMT temperature 1 (°C)', 'SMT temperature 2 (°C)', 'SMT temperature 3 (°C)', 
-    'SMT water content 1 (%)', 'SMT water content 2 (%)', 'SMT water content 3 (%)'
-]
-
 # Get unique devices and rooms
 devices = data['device'].unique()
 device_options = ['All'] + devices.tolist()
@@ -148,13 +343,6 @@ selected_devices = st.multiselect('Select Devices', device_options, default='All
 if 'All' in selected_devices:
     selected_devices = devices.tolist()
 
-parameter_options = ['Mariana'] + all_columns
-selected_parameters = st.multiselect('Select Parameters', parameter_options, default=parameter_options[:1])
-
-# Automatically select 'Mariana' parameters if 'Mariana' is chosen
-if 'Mariana' in selected_parameters:
-    selected_parameters = [param for param in selected_parameters if param != 'Mariana'] + [param for param in mariana_parameters if param in all_columns]
-
 # Check if start_date and end_date are valid
 try:
     start_date, end_date = st.date_input('Select Date Range', [data['timestamp'].min(), data['timestamp'].max()])
@@ -165,20 +353,20 @@ except Exception as e:
     st.error(f"Error with date input: {e}")
     st.stop()
 
-# Filter data by selected rooms, devices, and date range
-filtered_data = data[(data['room'].isin(selected_rooms)) & (data['device'].isin(selected_devices)) & (data['timestamp'] >= pd.to_datetime(start_date)) & (data['timestamp'] <= pd.to_datetime(end_date))]
-
-if selected_parameters and not filtered_data.empty:
-    for parameter in selected_parameters:
-        fig = px.line()
-        for device in selected_devices:
-            device_data = filtered_data[filtered_data['device'] == device]
-            fig.add_scatter(x=device_data['timestamp'], y=device_data[parameter], mode='lines', name=f'{device} - {parameter}', connectgaps=False)
-        fig.update_layout(title=f'Time Series Comparison for {parameter}', xaxis_title='Timestamp', yaxis_title=parameter, width=1200, height=600)
-        st.plotly_chart(fig, use_container_width=True)
-    
-    # Display the filtered data as a table below the plots
-    st.subheader('Raw Data')
-    st.dataframe(filtered_data)
-else:
-    st.write("No data available for the selected parameters and date range.")
+# Filter data by date range first, then by selected rooms and devices only when not everything is selected
+# Search the raw datetime64 array with datetime64 bounds to skip pandas Timestamp coercion
+timestamps = data['timestamp'].to_numpy()
+start_idx = timestamps.searchsorted(np.datetime64(start_date), side='left')
+end_idx = timestamps.searchsorted(np.datetime64(end_date), side='right')
+filtered_data = data.iloc[start_idx:end_idx]
+# Combine the room and device conditions into a single NumPy mask and index only once
+mask = np.ones(len(filtered_data), dtype=bool)
+if len(selected_rooms) < len(rooms):
+    mask &= filtered_data['room'].isin(selected_rooms).to_numpy()
+if len(selected_devices) < len(devices):
+    mask &= filtered_data['device'].isin(selected_devices).to_numpy()
+if not mask.all():
+    filtered_data = filtered_data[mask]
+
+# Plot the selected parameters for the filtered data
+show_visualizations(filtered_data, selected_devices, all_columns)